@@ -23,3 +23,10 @@ MAIL_SOURCE_FOLDER = "Indbakke/Udtræk af Tilmelding til Digital Post"
 EMAIL_STATUS_SENDER = "itk-rpa@mkb.aarhus.dk"
 EMAIL_USER = "itk-rpa@mkb.aarhus.dk"
 EMAIL_ATTACHMENT = "Tilmeldt Digital Post.xlsx"
+
+# The number of lookups to run against Serviceplatformen at the same time, unless set in the process arguments.
+# The threads spend nearly all their time waiting on the network, so this is set by latency, not by CPU cores.
+THREAD_COUNT = 32
+
+# The number of emails to handle at the same time
+MAIL_THREAD_COUNT = 4
@@ -4,22 +4,36 @@ import os
 import re
 import json
 from io import BytesIO
-from typing import Literal, List
+from typing import Literal
 import time
 import concurrent.futures
 
-from openpyxl import load_workbook
-from openpyxl.worksheet.worksheet import Worksheet
+from openpyxl import Workbook, load_workbook
 from hvac import Client
 
 from OpenOrchestrator.orchestrator_connection.connection import OrchestratorConnection
 from itk_dev_shared_components.graph import mail as graph_mail
 from itk_dev_shared_components.graph import authentication as graph_authentication
 from itk_dev_shared_components.smtp import smtp_util
-from python_serviceplatformen import digital_post
 from python_serviceplatformen.authentication import KombitAccess
 
 from robot_framework import config
+from robot_framework import registration_lookup
+
+
+_RECIPIENT_PATTERN = re.compile(r"mailto:([^\"]+)")
+_REQUEST_TYPE_PATTERN = re.compile(r"Digital Post eller NemSMS<br>([^<]+)")
+_CPR_PATTERN = re.compile(r"\d{10}")
+
+# KombitAccess objects by CVR, kept between retries of the process
+_kombit_access_cache: dict[str, KombitAccess] = {}
+
+# The services to look up for each request type in the email, with the request type in casefolded form
+_SERVICES_BY_REQUEST_TYPE = {
+    "digital post": ["Digital Post"],
+    "nemsms": ["NemSMS"],
+    "begge": ["Digital Post", "NemSMS"],
+}
 
 
 def process(orchestrator_connection: OrchestratorConnection) -> None:
@@ -27,6 +41,49 @@ def process(orchestrator_connection: OrchestratorConnection) -> None:
     orchestrator_connection.log_trace("Running process.")
     process_arguments = json.loads(orchestrator_connection.process_arguments)
 
+    thread_count = process_arguments.get("thread_count") or config.THREAD_COUNT
+
+    # Prepare access to email
+    graph_credentials = orchestrator_connection.get_credential(config.GRAPH_API)
+    graph_access = graph_authentication.authorize_by_username_password(graph_credentials.username, **json.loads(graph_credentials.password))
+    mails = graph_mail.get_emails_from_folder(config.EMAIL_USER, config.MAIL_SOURCE_FOLDER, graph_access)
+
+    if not mails:
+        return
+
+    # Prepare access to service platform. This is only done when there are emails, as it calls both Keyvault and Kombit
+    kombit_access = _get_kombit_access(orchestrator_connection, process_arguments["service_cvr"])
+    # Get the access token up front, so the lookup threads don't all request one at the same time if the cached one has expired
+    kombit_access.get_access_token(registration_lookup.ENTITY_ID)
+
+    orchestrator_connection.log_trace("Reading emails.")
+    # Registration results are shared between emails, so a CPR number requested in several emails is only looked up once
+    lookup_results = {}
+    # Handle several emails at the same time, so downloading and sending emails overlaps with lookups.
+    # All emails share one pool of lookup threads, which limits the total number of calls to Serviceplatformen.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as lookup_executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=min(len(mails), config.MAIL_THREAD_COUNT)) as executor:
+        all_futures = [executor.submit(_handle_mail, mail, kombit_access, graph_access, lookup_executor, lookup_results) for mail in mails]
+        for future in concurrent.futures.as_completed(all_futures):
+            rows_handled, rows_skipped, time_spent = future.result()
+            orchestrator_connection.log_info(f"{rows_handled} Rows handled. {rows_skipped} Rows skipped because of invalid CPR. Total time spent: {time_spent} seconds")
+
+
+def _get_kombit_access(orchestrator_connection: OrchestratorConnection, service_cvr: str) -> KombitAccess:
+    """ Get a KombitAccess object for the given CVR, using the certificate from Keyvault.
+    The object is cached for the lifetime of the robot, so a retry of the process
+    doesn't read the certificate again and can reuse the access tokens it has already fetched.
+
+    Args:
+        orchestrator_connection: The connection to OpenOrchestrator.
+        service_cvr: The CVR number to access Serviceplatformen as.
+
+    Returns:
+        A KombitAccess object for the given CVR.
+    """
+    if service_cvr in _kombit_access_cache:
+        return _kombit_access_cache[service_cvr]
+
     # Access Keyvault
     vault_auth = orchestrator_connection.get_credential(config.KEYVAULT_CREDENTIALS)
     vault_uri = orchestrator_connection.get_constant(config.KEYVAULT_URI).value
@@ -38,162 +95,187 @@ def process(orchestrator_connection: OrchestratorConnection) -> None:
     read_response = vault_client.secrets.kv.v2.read_secret_version(mount_point='rpa', path=config.KEYVAULT_PATH, raise_on_deleted_version=True)
     certificate = read_response['data']['data']['cert']
 
-    # Because KombitAccess requires a file, we save and delete the certificate after we use it
+    # Because KombitAccess requires a file, we save the certificate. It is read again whenever a token is renewed, so the file is kept
     certificate_path = "certificate.pem"
     with open(certificate_path, 'w', encoding='utf-8') as cert_file:
         cert_file.write(certificate)
 
-    # Prepare access to service platform
-    kombit_access = KombitAccess(process_arguments["service_cvr"], certificate_path, False)
-
-    # Prepare access to email
-    graph_credentials = orchestrator_connection.get_credential(config.GRAPH_API)
-    graph_access = graph_authentication.authorize_by_username_password(graph_credentials.username, **json.loads(graph_credentials.password))
-    mails = graph_mail.get_emails_from_folder(config.EMAIL_USER, config.MAIL_SOURCE_FOLDER, graph_access)
+    kombit_access = KombitAccess(service_cvr, certificate_path, False)
+    # Only cache the object once a token has been fetched with it, so a retry after a bad certificate reads Keyvault again
+    kombit_access.get_access_token(registration_lookup.ENTITY_ID)
+    _kombit_access_cache[service_cvr] = kombit_access
+    return kombit_access
 
-    for mail in mails:
-        orchestrator_connection.log_trace("Reading emails.")
-        # Get attachment from email
-        attachments = graph_mail.list_email_attachments(mail, graph_access)
-        email_attachment = graph_mail.get_attachment_data(attachments[0], graph_access)
-        # Get data from email text
-        requester = _get_recipient_from_email(mail.body)
-        request_type = _get_request_type_from_email(mail.body)
-        # Send and delete email
-        start_time = time.time()
-        return_data, rows_handled = handle_data(email_attachment, kombit_access, request_type, process_arguments["thread_count"])
 
-        orchestrator_connection.log_info(f"{rows_handled} Rows handled. Total time spent: {time.time()-start_time} seconds")
-        _send_status_email(requester, return_data)
-        graph_mail.delete_email(mail, graph_access)
+def _handle_mail(mail: graph_mail.Email, kombit_access: KombitAccess, graph_access: graph_authentication.GraphAccess, lookup_executor: concurrent.futures.Executor, lookup_results: dict[str, dict[str, bool]]) -> tuple[int, int, float]:
+    """ Lookup the CPR numbers in the attachment of a single email, send the result to the requester and delete the email.
 
+    Args:
+        mail: The email to handle.
+        kombit_access: Kombit Access Token
+        graph_access: The GraphAccess object used to authenticate against Graph.
+        lookup_executor: Thread pool to run the lookups in, shared between emails
+        lookup_results: Results of earlier lookups in this run, shared between emails
 
-def handle_data(input_file: BytesIO, access: KombitAccess, service_type: Literal['Digital Post', 'NemSMS', 'Begge'], thread_count: int) -> tuple[BytesIO, int]:
-    """ Read data from attachment, lookup each CPR number found and return a new file with added data.
+    Returns:
+        The number of rows handled, the number of rows skipped because of an invalid CPR number
+        and the time spent on the lookups in seconds.
+    """
+    # Get data from email text
+    requester = _get_recipient_from_email(mail.body)
+    request_type = _get_request_type_from_email(mail.body)
+    # Get attachment from email. It is closed as soon as the rows are read, so it isn't kept in memory during lookups
+    attachments = graph_mail.list_email_attachments(mail, graph_access)
+    start_time = time.time()
+    with graph_mail.get_attachment_data(attachments[0], graph_access) as email_attachment:
+        header, rows = _read_sheet(email_attachment)
+    # Send and delete email
+    return_data, rows_handled, rows_skipped = handle_data(header, rows, kombit_access, request_type, lookup_executor, lookup_results)
+    time_spent = time.time() - start_time
+
+    _send_status_email(requester, return_data)
+    graph_mail.delete_email(mail, graph_access)
+    return rows_handled, rows_skipped, time_spent
+
+
+def handle_data(header: tuple, rows: list[tuple], access: KombitAccess, service_type: Literal['Digital Post', 'NemSMS', 'Begge'], lookup_executor: concurrent.futures.Executor, lookup_results: dict[str, dict[str, bool]]) -> tuple[BytesIO, int, int]:
+    """ Lookup the CPR number in the first column of each row read from the attachment
+    and return a new file with the same rows and a status column for each service.
+    Rows that don't contain a valid CPR number aren't looked up, but are marked as invalid in the file.
 
     Args:
-        input_file: Excel-file with rows of CPR to work on
+        header: The header row read from the attachment with _read_sheet
+        rows: The data rows read from the attachment with _read_sheet
         access: Kombit Access Token
-        service_type: 'digitalpost', 'nemsms' or 'begge', to set which lookups to perform
+        service_type: 'Digital Post', 'NemSMS' or 'Begge' in any casing, to set which lookups to perform
+        lookup_executor: Thread pool to run the lookups in, shared between emails
+        lookup_results: Results of earlier lookups in this run, shared between emails
     Returns:
-        Filtered and formatted file with a list of people indicating whether they have Digital Post or not.
+        Filtered and formatted file with a list of people indicating whether they have Digital Post or not,
+        the number of rows looked up and the number of rows skipped because of an invalid CPR number.
     """
-    workbook = load_workbook(input_file)
-    input_sheet: Worksheet = workbook.active
+    # Rows without a CPR number are kept in the file, but aren't looked up or counted
+    cprs = [_format_cpr(row[0]) if row and row[0] is not None else None for row in rows]
+    is_valid = [cpr is not None and _CPR_PATTERN.fullmatch(cpr) is not None for cpr in cprs]
+    valid_cprs = [cpr for cpr, valid in zip(cprs, is_valid) if valid]
 
     # Check which services are requested
-    service = ["Digital Post", "NemSMS"] if service_type == "Begge" else [service_type]
-
-    # Call digital_post.is_registered for each input row and each required service
-    data = threaded_service_check(input_sheet, service, access, thread_count)
-    # data = linear_service_check(input_sheet, service, access)
-
-    # Add data to excel sheet
-    write_data_to_output_excel(service, data, input_sheet)
+    service = _SERVICES_BY_REQUEST_TYPE.get(service_type.strip().casefold())
+    if service is None:
+        raise ValueError(f"Unknown request type: '{service_type}'")
+
+    # Lookup registration for each input row and each required service
+    data = threaded_service_check(valid_cprs, service, access, lookup_executor, lookup_results)
+
+    # Write the result to a new workbook in write only mode, streaming one row at a time.
+    # Rows in read only mode are only as long as their last value, so they are padded to put the statuses in the same columns.
+    sheet_column_count = max(len(row) for row in [header, *rows])
+    output_workbook = Workbook(write_only=True)
+    output_sheet = output_workbook.create_sheet()
+    output_sheet.append([*_pad_row(header, sheet_column_count), *service])
+    service_types = [_format_service(s) for s in service]
+    for row, cpr, valid in zip(rows, cprs, is_valid):
+        if cpr is None:
+            statuses = []
+        elif valid:
+            statuses = ["Tilmeldt" if data[cpr][service_type] else "Ikke tilmeldt" for service_type in service_types]
+        else:
+            statuses = ["Ugyldigt CPR-nummer"] * len(service)
+        output_sheet.append([*_pad_row(row, sheet_column_count), *statuses])
 
     # Grab workbook from memory and return it
     byte_stream = BytesIO()
-    workbook.save(byte_stream)
+    output_workbook.save(byte_stream)
     byte_stream.seek(0)
-    return byte_stream, input_sheet.max_row
+    return byte_stream, len(valid_cprs), len(cprs) - cprs.count(None) - len(valid_cprs)
 
 
-def threaded_service_check(input_sheet: Worksheet, service: List[str], kombit_access: KombitAccess, thread_count: int) -> dict[str, dict[str, bool]]:
-    """ Call digital_post.is_registered for each input row and each required service.
+def _read_sheet(input_file: BytesIO) -> tuple[tuple, list[tuple]]:
+    """ Read the rows of the active sheet as plain values.
+    The workbook is opened in read only mode, so the sheet is streamed rather than loaded into memory.
 
     Args:
-        input_sheet: The input worksheet containing rows of data.
-        service: A list of services to check registration for.
-        kombit_access: An object providing access credentials for the API.
+        input_file: Excel-file with rows of CPR in the first column
 
     Returns:
-        A dictionary with CPR as keys and lists of service registration results as values.
+        The header row and the data rows in the order they appear in the sheet.
     """
-    iter_ = iter(input_sheet)
-    next(iter_)  # Skip header row
-
-    data = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor:
-        all_futures = {}
-        for row in iter_:
-            cpr = str(row[0].value).replace("-", "")  # Extract CPR from the row
-            if len(cpr) < 10:
-                cpr = "0" + cpr  # Add extra 0 if Excel removed it
-            for s in service:
-                service_type = s.replace(" ", "").lower()  # Format service name
-                # Submit the API call to the thread pool
-                future = executor.submit(digital_post.is_registered, cpr=cpr, service=service_type, kombit_access=kombit_access)
-                all_futures[future] = {"cpr": cpr, "service_type": service_type}
-
-        # Collect results as futures complete
-        for future in concurrent.futures.as_completed(all_futures):
-            cpr = all_futures[future]["cpr"]
-            service_type = all_futures[future]["service_type"]
-            if cpr not in data:
-                data[cpr] = {}
-            data[cpr][service_type] = future.result()  # Add the result to the corresponding CPR/service_type entry
-    return data
-
-
-def linear_service_check(input_sheet: Worksheet, service: List[str], kombit_access: KombitAccess) -> dict[str, dict[str, bool]]:
-    """ Call digital_post.is_registered for each input row and each required service.
+    workbook = load_workbook(input_file, read_only=True, data_only=True)
+    try:
+        input_sheet = workbook.active
+        input_sheet.reset_dimensions()  # Some files have wrong dimensions saved, which would cut rows off
+        rows = input_sheet.iter_rows(values_only=True)
+        header = next(rows, ())
+        return header, list(rows)
+    finally:
+        # Read only workbooks keep the file open until they are closed
+        workbook.close()
+
+
+def threaded_service_check(cprs: list[str], service: list[str], kombit_access: KombitAccess, executor: concurrent.futures.Executor, data: dict[str, dict[str, bool]]) -> dict[str, dict[str, bool]]:
+    """ Lookup registration for each input row and each required service.
+    Results already in data from earlier emails in the same run are reused instead of being looked up again.
 
     Args:
-        input_sheet: The input worksheet containing rows of data.
+        cprs: The CPR numbers read from the input sheet.
         service: A list of services to check registration for.
         kombit_access: An object providing access credentials for the API.
+        executor: The thread pool to run the requests in.
+        data: Results of earlier lookups in this run. New results are added to it.
 
     Returns:
-        A dictionary with CPR as keys and dictionary of service registration results as bools.
+        A dictionary with CPR as keys and dictionaries of service type to registration status as values.
     """
-    iter_ = iter(input_sheet)
-    next(iter_)  # Skip header row
-
-    data = {}
-    for row in iter_:
-        cpr = row[0].value  # Extract CPR from the row
-        for s in service:
-            serviceportal_type = s.replace(" ", "").lower()  # Format service name
-            result = digital_post.is_registered(cpr=cpr, service=serviceportal_type, kombit_access=kombit_access)
-            if cpr not in data:
-                data[cpr] = {}
-            data[cpr][serviceportal_type] = result
+    service_types = [_format_service(s) for s in service]
+
+    # Only look up each CPR once, even if it appears multiple times in the sheet or was looked up for an earlier email
+    lookups = [(cpr, service_type) for cpr in set(cprs) for service_type in service_types if service_type not in data.get(cpr, {})]
+
+    # A single lookup is run directly, as handing it to the thread pool would only add overhead
+    if len(lookups) == 1:
+        cpr, service_type = lookups[0]
+        data.setdefault(cpr, {})[service_type] = registration_lookup.is_registered(cpr=cpr, service=service_type, kombit_access=kombit_access)
+        return data
 
+    # Run the API calls in the thread pool. The results come back in the same order as the lookups
+    results = executor.map(lambda lookup: registration_lookup.is_registered(*lookup, kombit_access=kombit_access), lookups)
+    for (cpr, service_type), result in zip(lookups, results):
+        data.setdefault(cpr, {})[service_type] = result  # Add the result to the corresponding CPR/service_type entry
     return data
 
 
-def write_data_to_output_excel(service: list[str], data: dict[str, dict[str, bool]], target_sheet: Worksheet) -> None:
-    """ Add data to excel sheet.
+def _pad_row(row: tuple, length: int) -> list:
+    """ Pad a row with empty cells to the given length."""
+    return [*row, *[None] * (length - len(row))]
 
-    Args:
-        service: Which services we add a status for
-        data: A dictionary of id's with a list of booleans indicating if the id is registered with the service
-        target_sheet: A sheet with id's in the first row
-    """
-    sheet_column_count = target_sheet.max_column
-    # Write headers
-    for col, s in enumerate(service, start=sheet_column_count + 1):  # Start from column 2 to avoid overwriting ID column
-        # Write sheet headers for service types
-        target_sheet.cell(row=1, column=col, value=s)
-        # Go through rows of the sheet
-        for row_idx, row in enumerate(target_sheet.iter_rows(min_row=2, max_col=1), start=2):
-            cpr = str(row[0].value).replace("-", "")
-            # Grab value of cpr-service_type from data dictionary and add to column
-            status = data[cpr][s.replace(" ", "").lower()]
-            status = "Tilmeldt" if status else "Ikke tilmeldt"
-            target_sheet.cell(row=row_idx, column=col, value=status)
+
+def _format_cpr(value) -> str:
+    """ Format a CPR number read from a cell as a string of 10 digits."""
+    cpr = str(value).strip().replace("-", "")
+    if len(cpr) == 9:
+        cpr = "0" + cpr  # Add extra 0 if Excel removed it
+    return cpr
+
+
+def _format_service(service: str) -> str:
+    """ Format a service name as used in the email, e.g. 'Digital Post', as the service type used by Serviceplatformen."""
+    return service.replace(" ", "").lower()
 
 
 def _get_recipient_from_email(user_data: str) -> str:
     """ Find email in user_data using regex."""
-    pattern = r"mailto:([^\"]+)"
-    return re.findall(pattern, user_data)[0]
+    match = _RECIPIENT_PATTERN.search(user_data)
+    if not match:
+        raise ValueError("Couldn't find the recipient in the email.")
+    return match.group(1)
 
 
 def _get_request_type_from_email(user_data: str) -> str:
     """ Find request type in user_data using regex."""
-    pattern = r"Digital Post eller NemSMS<br>([^<]+)"
-    return re.findall(pattern, user_data)[0]
+    match = _REQUEST_TYPE_PATTERN.search(user_data)
+    if not match:
+        raise ValueError("Couldn't find the request type in the email.")
+    return match.group(1).strip()
 
 
 def _send_status_email(recipient: str, file: BytesIO):
@@ -217,6 +299,6 @@ def _send_status_email(recipient: str, file: BytesIO):
 if __name__ == '__main__':
     conn_string = os.getenv("OpenOrchestratorConnString")
     crypto_key = os.getenv("OpenOrchestratorKey")
-    PROCESS_VARIABLES = r'{"service_cvr":"55133018", "thread_count":1}'
+    PROCESS_VARIABLES = r'{"service_cvr":"55133018"}'
     oc = OrchestratorConnection("Udtræk Tilmelding Digital Post", conn_string, crypto_key, PROCESS_VARIABLES)
     process(oc)
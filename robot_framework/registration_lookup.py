@@ -0,0 +1,72 @@
+"""This module has functionality to look up registrations for Digital Post and NemSMS in Serviceplatformen."""
+
+import threading
+import urllib.parse
+import uuid
+from datetime import datetime
+from typing import Literal
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+from python_serviceplatformen.authentication import KombitAccess
+from python_serviceplatformen.date_helper import format_datetime
+
+
+ENTITY_ID = "http://entityid.kombit.dk/service/postforespoerg/1"
+
+# KombitAccess caches its tokens but isn't thread safe, so only one thread may fetch a new token at a time
+_token_lock = threading.Lock()
+
+# requests.Session isn't guaranteed to be thread safe, so each thread gets its own
+_thread_local = threading.local()
+
+
+def _get_session() -> requests.Session:
+    """Get the session of the current thread, creating it on first use.
+    The session keeps its connection to Serviceplatformen open, so each lookup doesn't need a new TCP and TLS handshake.
+
+    Returns:
+        The session of the current thread.
+    """
+    if not hasattr(_thread_local, "session"):
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(max_retries=Retry(total=3, backoff_factor=0.2)))
+        _thread_local.session = session
+    return _thread_local.session
+
+
+def is_registered(cpr: str, service: Literal['digitalpost', 'nemsms'], kombit_access: KombitAccess) -> bool:
+    """Check if the person with the given cpr number is registered for either Digital Post or NemSMS.
+    This is the same call as digital_post.is_registered, but sent through a session kept open by the current thread.
+    The PostForespoerg service has a separate endpoint per service and only takes a single cpr number per call,
+    so lookups can't be batched, and "Begge" needs one call per service.
+
+    Args:
+        cpr: The cpr number of the person to look up.
+        service: The service to look up for.
+        kombit_access: The KombitAccess object used to authenticate.
+
+    Returns:
+        True if the person is registered for the selected service.
+    """
+    url = urllib.parse.urljoin(kombit_access.environment, "service/PostForespoerg_1/")
+    url = urllib.parse.urljoin(url, service)
+
+    parameters = {
+        "cprNumber": cpr
+    }
+
+    with _token_lock:
+        access_token = kombit_access.get_access_token(ENTITY_ID)
+
+    headers = {
+        "X-TransaktionsId": str(uuid.uuid4()),
+        "X-TransaktionsTid": format_datetime(datetime.now()),
+        "authorization": access_token
+    }
+
+    response = _get_session().get(url, params=parameters, headers=headers, timeout=10)
+    response.raise_for_status()
+    return response.json()['result']